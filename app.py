@@ -1,13 +1,37 @@
+import atexit
+import collections
 import os
+import pathlib
 import shutil
-import subprocess
 import tempfile
-import glob
+import threading
+import uuid
 
 import gradio as gr
 
-# Path to the original script
-SCRIPT_PATH = os.path.join(os.path.dirname(__file__), "picToGDS.py")
+from picToGDS import main as pic_to_gds_main
+
+# Each conversion writes into its own subdirectory of OUT_ROOT, a private
+# directory created for this process; only the most recent MAX_KEPT_OUTPUTS
+# are kept so old results don't pile up on disk, and the whole root is
+# removed when the process exits
+OUT_ROOT = pathlib.Path(tempfile.mkdtemp(prefix="pic2gds_"))
+atexit.register(shutil.rmtree, OUT_ROOT, ignore_errors=True)
+MAX_KEPT_OUTPUTS = 32
+
+_recent_outputs = collections.deque()
+_recent_outputs_lock = threading.Lock()
+
+
+def _new_output_dir():
+    """Create a fresh output directory and drop the oldest ones beyond the limit"""
+    out_dir = OUT_ROOT / uuid.uuid4().hex
+    out_dir.mkdir()
+    with _recent_outputs_lock:
+        _recent_outputs.append(out_dir)
+        while len(_recent_outputs) > MAX_KEPT_OUTPUTS:
+            shutil.rmtree(_recent_outputs.popleft(), ignore_errors=True)
+    return str(out_dir)
 
 
 def convert_to_gds(
@@ -20,7 +44,7 @@ def convert_to_gds(
     invert_gds,
 ):
     """
-    Wraps picToGDS.py CLI:
+    Runs picToGDS.main in-process, equivalent to the CLI:
         python picToGDS.py [--scale SCALE] [-d] [--threshold_offset OFFSET] [--invert]
                            fileName sizeOfTheCell layerNum
     """
@@ -35,71 +59,34 @@ def convert_to_gds(
     except ValueError:
         raise gr.Error("Cell size, layer, scale and threshold offset must be numeric.")
 
-    # Work in an isolated temp directory so multiple users don't clash
-    with tempfile.TemporaryDirectory() as tmpdir:
-        # Copy the uploaded file into the temp dir
-        if isinstance(image_path, str):
-            in_name = os.path.basename(image_path)
-            in_path = os.path.join(tmpdir, in_name)
-            shutil.copy(image_path, in_path)
-        else:
-            # Should not normally happen with Image(type="filepath"),
-            # but just in case we get a dict-like object
-            in_path = os.path.join(tmpdir, "input.png")
-            image_path.save(in_path)  # type: ignore
-
-        # Build CLI command
-        cmd = ["python", SCRIPT_PATH]
-        if scale != 1.0:
-            cmd += ["--scale", str(scale)]
-        if use_dithering:
-            cmd.append("-d")
-        # Always pass the offset (0 = default behavior)
-        cmd += ["--threshold_offset", str(offset)]
-        if invert_gds:
-            cmd.append("--invert")
-        cmd += [os.path.basename(in_path), str(cell_size), str(layer)]
-
-        result = subprocess.run(
-            cmd,
-            cwd=tmpdir,
-            capture_output=True,
-            text=True,
-        )
-
-        if result.returncode != 0:
-            raise gr.Error(
-                "picToGDS failed:\n\n"
-                f"STDOUT:\n{result.stdout}\n\nSTDERR:\n{result.stderr}"
-            )
-
-        # Find generated files
-        gds_files = glob.glob(os.path.join(tmpdir, "*.gds"))
-        bmp_files = glob.glob(os.path.join(tmpdir, "*.bmp"))
+    # A per-request directory, so multiple users don't clash and Gradio can
+    # serve the files after we return
+    out_dir = _new_output_dir()
 
-        if not gds_files:
-            raise gr.Error("No GDS file was created by picToGDS.py.")
+    try:
+        # Image(type="filepath") always hands us the path of the upload
+        pic_to_gds_main(
+            image_path,
+            cell_size,
+            layer,
+            use_dithering,
+            offset,
+            scale,
+            invert_gds,
+            out_dir=out_dir,
+        )
+    except Exception as e:
+        raise gr.Error(f"picToGDS failed:\n\n{e}")
 
-        gds_src = gds_files[0]
-        bmp_src = bmp_files[0] if bmp_files else None
+    gds_out = os.path.join(out_dir, "image.gds")
+    png_out = os.path.join(out_dir, "image.png")
 
-        # Copy them to another temp dir which we *don't* auto-delete,
-        # so Gradio can serve the files after we exit the context manager
-        out_dir = tempfile.mkdtemp(prefix="pic2gds_")
-        gds_out = shutil.copy(
-            gds_src,
-            os.path.join(out_dir, os.path.basename(gds_src)),
-        )
-        bmp_out = None
-        if bmp_src is not None:
-            bmp_out = shutil.copy(
-                bmp_src,
-                os.path.join(out_dir, os.path.basename(bmp_src)),
-            )
+    if not os.path.exists(gds_out):
+        raise gr.Error("No GDS file was created by picToGDS.")
 
-        # First return: path for the DownloadButton
-        # Second return: path for the BMP preview
-        return gds_out, bmp_out
+    # First return: path for the DownloadButton
+    # Second return: path for the PNG preview
+    return gds_out, png_out if os.path.exists(png_out) else None
 
 
 # ----- Gradio UI -----
@@ -148,7 +135,7 @@ outputs = [
         value=None,
     ),
     gr.Image(
-        label="Preview of binary image (BMP)",
+        label="Preview of binary image",
         type="filepath",
     ),
 ]
@@ -4,26 +4,196 @@
 
 import cv2
 import numpy as np
-import gdspy
 
 import argparse
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import gdspy
 
-def minmax(v):
-    if v > 255:
+    gdstk = None
+except ImportError:
+    # Without gdspy the layout is written with gdstk instead. gdspy is
+    # preferred: _QuadSet writes all quads in one block, while gdstk needs
+    # one Polygon object per quad.
+    gdspy = None
+    import gdstk
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional: without it the kernels below run as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+
+# Longest side of the preview image, in pixels
+_PREVIEW_MAX_DIM = 1024
+
+# gdspy keeps process-global state (gdspy.current_library), so building and
+# writing a layout with it must not interleave between threads
+_GDS_LOCK = threading.Lock()
+
+
+@njit(cache=True, fastmath=True)
+def _fs_dither_pixel(row, below, x):
+    """Quantize row[x] and diffuse its error to the four neighbours
+
+    row and below are consecutive rows of the image, so _fs_dither indexes
+    1-D views instead of the 2-D array.
+    """
+    old_p = int(row[x])
+    new_p = 255 if old_p >= 128 else 0
+    row[x] = new_p
+    err = old_p - new_p
+
+    # Error is spread with floor division and every neighbour is
+    # clamped to [0, 255] before it is stored back
+    v = int(row[x + 1]) + err * 7 // 16
+    if v < 0:
+        v = 0
+    elif v > 255:
         v = 255
+    row[x + 1] = v
+
+    v = int(below[x - 1]) + err * 3 // 16
     if v < 0:
         v = 0
-    return v
+    elif v > 255:
+        v = 255
+    below[x - 1] = v
 
+    v = int(below[x]) + err * 5 // 16
+    if v < 0:
+        v = 0
+    elif v > 255:
+        v = 255
+    below[x] = v
+
+    v = int(below[x + 1]) + err // 16
+    if v < 0:
+        v = 0
+    elif v > 255:
+        v = 255
+    below[x + 1] = v
+
+
+@njit(cache=True, fastmath=True)
+def _fs_dither(gray):
+    """Floyd–Steinberg dithering of a 2-D uint8 image, in place
+    https://en.wikipedia.org/wiki/Floyd%E2%80%93Steinberg_dithering
+    """
+    height, width = gray.shape
+    # Local bindings keep the plain-Python fallback off global lookups and
+    # 2-D indexing in the inner loop
+    step = _fs_dither_pixel
+    x_end = width - 1
+    for y in range(0, height - 1):
+        row = gray[y]
+        below = gray[y + 1]
+        for x in range(1, x_end):
+            step(row, below, x)
+
+
+@njit(cache=True)
+def _fill_corners(mask, value):
+    """Fill orthological corners of a 2-D boolean mask, in place
+
+    Pixels equal to value are the ones being filled in, so the same kernel
+    works on an inverted mask. Windows are visited column by column, so a
+    filled pixel is already seen by the 2x2 windows that follow it.
+    """
+    height, width = mask.shape
+    for x in range(width - 1):
+        for y in range(height - 1):
+            tl = mask[y, x] == value
+            bl = mask[y + 1, x] == value
+            tr = mask[y, x + 1] == value
+            br = mask[y + 1, x + 1] == value
+            if tl and not bl and not tr and br:
+                mask[y + 1, x] = value
+            elif not tl and bl and tr and not br:
+                mask[y + 1, x + 1] = value
 
-def main(fileName, sizeOfTheCell, layerNum, isDither, threshold_offset, scale, invert=False):
+
+if gdspy is not None:
+
+    class _QuadSet(gdspy.PolygonSet):
+        """PolygonSet of quads on a single layer, written to GDSII in one block
+
+        gdspy packs and writes the records of each polygon separately. Here
+        the BOUNDARY, LAYER, DATATYPE, XY and ENDEL records of all quads are
+        laid out in one structured array and written with a single call.
+        """
+
+        _RECORD = np.dtype(
+            [
+                ("head", ">i2", 8),
+                ("xy_head", ">i2", 2),
+                ("xy", ">i4", (5, 2)),
+                ("tail", ">i2", 2),
+            ]
+        )
+
+        def __init__(self, quads, layer=0, datatype=0):
+            self.polygons = quads
+            self.layers = [layer] * len(quads)
+            self.datatypes = [datatype] * len(quads)
+            self.properties = {}
+
+        def to_gds(self, outfile, multiplier):
+            if len(self.polygons) == 0:
+                return
+            records = np.empty(len(self.polygons), dtype=self._RECORD)
+            records["head"] = (
+                4, 0x0800, 6, 0x0D02, self.layers[0], 6, 0x0E02, self.datatypes[0]
+            )
+            records["xy_head"] = (4 + 8 * 5, 0x1003)
+            records["xy"][:, :4] = np.round(self.polygons * multiplier)
+            records["xy"][:, 4] = records["xy"][:, 0]
+            records["tail"] = (4, 0x1100)
+            outfile.write(records.tobytes())
+
+
+def _write_preview(path, black):
+    """Write a black-pixel mask as an image, downsampled so its longer side is
+    at most _PREVIEW_MAX_DIM pixels
+    """
+    height, width = black.shape
+    preview = np.where(black, np.uint8(0), np.uint8(255))
+    if max(height, width) > _PREVIEW_MAX_DIM:
+        ratio = _PREVIEW_MAX_DIM / max(height, width)
+        preview = cv2.resize(
+            preview,
+            (max(1, int(width * ratio)), max(1, int(height * ratio))),
+            interpolation=cv2.INTER_AREA,
+        )
+    cv2.imwrite(path, preview)
+
+
+def main(
+    fileName,
+    sizeOfTheCell,
+    layerNum,
+    isDither,
+    threshold_offset,
+    scale,
+    invert=False,
+    out_dir=".",
+):
     """Convert an image file (fileName) to a GDS file
+
+    image.png (preview) and image.gds are written to out_dir.
     """
     print("Converting an image file to a GDS file..")
 
     # ---- Load image safely ----
-    img_raw = cv2.imread(fileName)
+    # Colour is discarded anyway, so decode straight to grayscale
+    img_raw = cv2.imread(fileName, cv2.IMREAD_GRAYSCALE)
     if img_raw is None:
         raise FileNotFoundError(f"Could not read image from path: {fileName}")
 
@@ -33,91 +203,122 @@ def main(fileName, sizeOfTheCell, layerNum, isDither, threshold_offset, scale, i
         scale = 1.0
 
     # Read an image file with scaling
-    img = cv2.resize(img_raw, dsize=None, fx=scale, fy=scale)
+    gray = cv2.resize(img_raw, dsize=None, fx=scale, fy=scale)
 
-    width = img.shape[1]
-    height = img.shape[0]
+    width = gray.shape[1]
+    height = gray.shape[0]
     print(f"width:{width}")
     print(f"height:{height}")
 
-    # Convert image to grayscale
-    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-
     # Optional Floyd–Steinberg dithering
     if isDither:
-        # Floyd–Steinberg dithering
-        # https://en.wikipedia.org/wiki/Floyd%E2%80%93Steinberg_dithering
-        for y in range(0, height - 1):
-            for x in range(1, width - 1):
-                old_p = gray[y, x]
-                new_p = np.round(old_p / 255.0) * 255
-                gray[y, x] = new_p
-                error_p = old_p - new_p
-                gray[y, x + 1]     = minmax(gray[y, x + 1]     + error_p * 7 / 16.0)
-                gray[y + 1, x - 1] = minmax(gray[y + 1, x - 1] + error_p * 3 / 16.0)
-                gray[y + 1, x]     = minmax(gray[y + 1, x]     + error_p * 5 / 16.0)
-                gray[y + 1, x + 1] = minmax(gray[y + 1, x + 1] + error_p * 1 / 16.0)
+        _fs_dither(gray)
 
     # --- Thresholding: Otsu + user offset ---
-    T_otsu, _ = cv2.threshold(gray, 0, 255, cv2.THRESH_OTSU)
-    T_effective = T_otsu + threshold_offset
-    T_effective = float(np.clip(T_effective, 0, 255))
+    # The threshold writes 1 for black pixels and 0 for white ones, which is
+    # viewed as a boolean mask without a copy. Inversion (black ↔ white) is
+    # done by the threshold itself.
+    thr_flag = cv2.THRESH_BINARY if invert else cv2.THRESH_BINARY_INV
+
+    if threshold_offset == 0.0:
+        # Without an offset Otsu's threshold is used as is, in a single pass
+        T_otsu, binaryImage = cv2.threshold(
+            gray, 0, 1, thr_flag | cv2.THRESH_OTSU
+        )
+        T_effective = T_otsu
+    else:
+        T_otsu, _ = cv2.threshold(gray, 0, 255, cv2.THRESH_OTSU)
+        T_effective = T_otsu + threshold_offset
+        T_effective = float(np.clip(T_effective, 0, 255))
+        _, binaryImage = cv2.threshold(gray, T_effective, 1, thr_flag)
     print(f"Otsu threshold: {T_otsu}, offset: {threshold_offset}, effective: {T_effective}")
 
-    _, binaryImage = cv2.threshold(gray, T_effective, 255, cv2.THRESH_BINARY)
+    black = binaryImage.view(np.bool_)
 
     # Fill orthological corner (as in original script)
-    for x in range(width - 1):
-        for y in range(height - 1):
-            if (
-                binaryImage[y, x] == 0
-                and binaryImage[y + 1, x] == 255
-                and binaryImage[y, x + 1] == 255
-                and binaryImage[y + 1, x + 1] == 0
-            ):
-                binaryImage[y + 1, x] = 0
-            elif (
-                binaryImage[y, x] == 255
-                and binaryImage[y + 1, x] == 0
-                and binaryImage[y, x + 1] == 0
-                and binaryImage[y + 1, x + 1] == 255
-            ):
-                binaryImage[y + 1, x + 1] = 0
-
-    # Invert image if requested
-    if invert:
-        binaryImage = 255 - binaryImage
-
-    # Output image.bmp (preview)
-    cv2.imwrite("image.bmp", binaryImage)
-
-    # The GDSII file is called a library, which contains multiple cells.
-    lib = gdspy.GdsLibrary()
-    gdspy.current_library = gdspy.GdsLibrary()
-
-    # Geometry must be placed in cells.
-    unitCell = lib.new_cell("CELL")
-    square = gdspy.Rectangle((0.0, 0.0), (1.0, 1.0), layer=int(layerNum))
-    unitCell.add(square)
-
-    grid = lib.new_cell("GRID")
+    # The fill always works on the un-inverted image: with invert set, the
+    # pixels to fill are the white ones of the mask.
+    _fill_corners(black, not invert)
 
-    # IMPORTANT: keep original orientation mapping: (x, height - y - 1)
-    for x in range(width):
-        for y in range(height):
-            if binaryImage[y, x] == 0:
-                # print(f"({x}, {y}) is black")
-                cell = gdspy.CellReference(unitCell, origin=(x, height - y - 1))
-                grid.add(cell)
-
-    scaledGrid = gdspy.CellReference(
-        grid, origin=(0, 0), magnification=float(sizeOfTheCell)
+    # Output image.png (preview) on a worker thread; cv2 releases the GIL
+    # while encoding, so it overlaps with building the GDS below
+    executor = ThreadPoolExecutor(max_workers=1)
+    preview_done = executor.submit(
+        _write_preview, os.path.join(out_dir, "image.png"), black
     )
+    executor.shutdown(wait=False)
+
+    # Coalesce black pixels into rectangles: find the horizontal runs of every
+    # row, then stack runs with identical bounds in consecutive rows.
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = black
+    edges = np.diff(padded, axis=1)
+    ys, x0 = np.nonzero(edges == 1)
+    _, x1 = np.nonzero(edges == -1)
+
+    order = np.lexsort((ys, x1, x0))
+    ys, x0, x1 = ys[order], x0[order], x1[order]
+    starts = np.ones(len(ys), dtype=bool)
+    starts[1:] = (x0[1:] != x0[:-1]) | (x1[1:] != x1[:-1]) | (ys[1:] != ys[:-1] + 1)
+    ends = np.ones(len(ys), dtype=bool)
+    ends[:-1] = starts[1:]
+    y_top = ys[starts]
+    y_bottom = ys[ends]
+    x0 = x0[starts]
+    x1 = x1[starts]
+
+    # IMPORTANT: keep original orientation mapping: (x, height - y - 1)
+    xa = x0.astype(np.float64)
+    xb = x1.astype(np.float64)
+    ya = (height - y_bottom - 1).astype(np.float64)
+    yb = (height - y_top).astype(np.float64)
+    quads = np.empty((len(xa), 4, 2))
+    quads[:, 0, 0], quads[:, 0, 1] = xa, ya
+    quads[:, 1, 0], quads[:, 1, 1] = xb, ya
+    quads[:, 2, 0], quads[:, 2, 1] = xb, yb
+    quads[:, 3, 0], quads[:, 3, 1] = xa, yb
+
+    gds_path = os.path.join(out_dir, "image.gds")
+    if gdspy is not None:
+        with _GDS_LOCK:
+            # The GDSII file is called a library, which contains multiple cells.
+            # A fresh library per call keeps cell names from clashing between
+            # runs.
+            lib = gdspy.GdsLibrary()
+            gdspy.current_library = lib
+
+            # Geometry must be placed in cells.
+            # All rectangles go into GRID as a single set of quads
+            grid = lib.new_cell("GRID")
+            if len(quads):
+                grid.add(_QuadSet(quads, layer=int(layerNum)))
+
+            scaledGrid = gdspy.CellReference(
+                grid, origin=(0, 0), magnification=float(sizeOfTheCell)
+            )
+
+            # Add the top-cell to a layout and save
+            top = lib.new_cell("TOP")
+            top.add(scaledGrid)
+            lib.write_gds(gds_path)
+    else:
+        # The GDSII file is called a library, which contains multiple cells.
+        lib = gdstk.Library()
+
+        # Geometry must be placed in cells.
+        grid = lib.new_cell("GRID")
+        grid.add(*[gdstk.Polygon(q, layer=int(layerNum)) for q in quads])
+
+        scaledGrid = gdstk.Reference(
+            grid, origin=(0, 0), magnification=float(sizeOfTheCell)
+        )
+
+        # Add the top-cell to a layout and save
+        top = lib.new_cell("TOP")
+        top.add(scaledGrid)
+        lib.write_gds(gds_path)
 
-    # Add the top-cell to a layout and save
-    top = lib.new_cell("TOP")
-    top.add(scaledGrid)
-    lib.write_gds("image.gds")
+    preview_done.result()
 
 
 if __name__ == "__main__":